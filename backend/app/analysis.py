@@ -1,9 +1,17 @@
 import os
+import time
 import logging
-from typing import Optional
+import threading
+import statistics
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 import google.generativeai as genai
 
+from .similarity import get_analysis_index
+from .usage import get_usage_meter
+from .replay import get_replay_store
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -37,6 +45,113 @@ SYSTEM_PROMPT = (
     "conversational phrases."
 )
 
+# --- Retrieval Configuration ---
+# Number of similar earlier scenes from the same child added to the prompt
+CONTEXT_TOP_K = int(os.getenv("ANALYSIS_CONTEXT_TOP_K", "3"))
+# Earlier scenes below this similarity are not relevant enough to include
+CONTEXT_MIN_SIMILARITY = float(os.getenv("ANALYSIS_CONTEXT_MIN_SIMILARITY", "0.3"))
+# Captions at or above this similarity reuse the earlier analysis without an LLM call
+REUSE_SIMILARITY = float(os.getenv("ANALYSIS_REUSE_SIMILARITY", "0.98"))
+# Earlier analyses are truncated to keep the prompt short
+CONTEXT_ANALYSIS_CHARS = 500
+
+# --- Model Routing Configuration ---
+# Custom-prompt and session analyses use the primary model, plain captions the fast one
+PRIMARY_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-pro-latest")
+FAST_MODEL_NAME = os.getenv("GEMINI_FAST_MODEL_NAME", "gemini-1.5-flash-latest")
+# A model is degraded when its median latency or error rate crosses these thresholds
+ROUTER_LATENCY_THRESHOLD_MS = float(os.getenv("ROUTER_LATENCY_THRESHOLD_MS", "20000"))
+ROUTER_ERROR_RATE_THRESHOLD = float(os.getenv("ROUTER_ERROR_RATE_THRESHOLD", "0.5"))
+# Only calls from the last window count, so a degraded model is retried once it ages out
+ROUTER_WINDOW_SECONDS = float(os.getenv("ROUTER_WINDOW_SECONDS", "300"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+
+
+class ModelRouter:
+    """
+    Route analyses between a primary and a fast Gemini model.
+
+    Simple requests go to the fast model and complex ones to the primary
+    model. When the chosen model's recent median latency or error rate
+    crosses a threshold, traffic shifts to the other model while it is
+    healthy.
+    """
+
+    def __init__(self, primary_model: str, fast_model: str,
+                 latency_threshold_ms: float = ROUTER_LATENCY_THRESHOLD_MS,
+                 error_rate_threshold: float = ROUTER_ERROR_RATE_THRESHOLD,
+                 window_seconds: float = ROUTER_WINDOW_SECONDS,
+                 min_samples: int = ROUTER_MIN_SAMPLES):
+        self.primary_model = primary_model
+        self.fast_model = fast_model
+        self.latency_threshold_ms = latency_threshold_ms
+        self.error_rate_threshold = error_rate_threshold
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self._calls: Dict[str, Deque[Tuple[float, float, bool]]] = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, model: str) -> List[Tuple[float, float, bool]]:
+        calls = self._calls.setdefault(model, deque(maxlen=100))
+        cutoff = time.monotonic() - self.window_seconds
+        while calls and calls[0][0] < cutoff:
+            calls.popleft()
+        return list(calls)
+
+    def is_degraded(self, model: str) -> bool:
+        """
+        Check whether a model's recent calls are too slow or failing too often.
+
+        Args:
+            model: Gemini model name.
+
+        Returns:
+            bool: True if the model crossed the latency or error-rate threshold.
+        """
+        with self._lock:
+            calls = self._recent(model)
+        if len(calls) < self.min_samples:
+            return False
+        error_rate = sum(1 for _, _, ok in calls if not ok) / len(calls)
+        median_latency = statistics.median(latency for _, latency, _ in calls)
+        return error_rate >= self.error_rate_threshold or median_latency >= self.latency_threshold_ms
+
+    def select(self, complex_request: bool) -> str:
+        """
+        Choose the model for a request.
+
+        Args:
+            complex_request: Whether the request needs the primary model
+                (custom prompt or multi-photo session).
+
+        Returns:
+            str: Gemini model name.
+        """
+        preferred, fallback = (
+            (self.primary_model, self.fast_model) if complex_request
+            else (self.fast_model, self.primary_model)
+        )
+        if self.is_degraded(preferred) and not self.is_degraded(fallback):
+            logger.warning(f"Model '{preferred}' is degraded, routing to '{fallback}'.")
+            return fallback
+        return preferred
+
+    def record(self, model: str, latency_ms: float, ok: bool) -> None:
+        """
+        Record the outcome of a call.
+
+        Args:
+            model: Gemini model name.
+            latency_ms: Wall-clock latency of the call in milliseconds.
+            ok: Whether the call succeeded.
+        """
+        with self._lock:
+            self._recent(model)
+            self._calls[model].append((time.monotonic(), latency_ms, ok))
+
+
+router = ModelRouter(PRIMARY_MODEL_NAME, FAST_MODEL_NAME)
+
 def generate_psychological_analysis(
     caption: str, user_id: Optional[str] = None, custom_prompt: Optional[str] = None
 ) -> str:
@@ -45,19 +160,39 @@ def generate_psychological_analysis(
     
     Args:
         caption: Sandbox scene description.
-        user_id: User ID (optional, for future use).
+        user_id: User ID (optional). When given, similar earlier scenes from the
+            same user are added to the prompt and the result is indexed.
         custom_prompt: An optional user-provided prompt to guide the analysis.
         
     Returns:
         str: Psychological analysis text from the Gemini model.
+        
+    Raises:
+        QuotaExceededError: If the user's daily token quota is used up.
     """
-    if not genai:
+    if not genai and get_replay_store().mode != "replay":
         error_message = "Gemini API client is not configured. Please set the GEMINI_API_KEY in your .env file."
         logger.error(error_message)
         return error_message
 
-    model_name = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-pro-latest")
-    
+    matches = []
+    if user_id:
+        try:
+            matches = get_analysis_index().search(user_id, caption, CONTEXT_TOP_K)
+        except Exception as e:
+            logger.warning(f"Similarity lookup failed for user {user_id}: {e}")
+
+    # Near-identical scenes from the same child reuse an earlier default-prompt analysis
+    reusable = [
+        (score, record) for score, record in matches
+        if score >= REUSE_SIMILARITY and record.get("custom_prompt") is False
+    ]
+    if reusable and not custom_prompt:
+        score, record = reusable[0]
+        logger.info(f"Reusing earlier analysis for user {user_id} (similarity {score:.3f}).")
+        get_usage_meter().record(user_id, record.get("model") or "unknown", cache_hit=True)
+        return record["analysis"]
+
     # Construct the final prompt for the user role
     if custom_prompt:
         user_prompt = f"{custom_prompt}\n\nBased on the instruction above, please provide a psychological analysis for the following sandbox scene: '{caption}'"
@@ -66,25 +201,135 @@ def generate_psychological_analysis(
         user_prompt = f"Please provide a psychological analysis for the following sandbox scene: '{caption}'"
         logger.info(f"Using default prompt for analysis.")
 
-    logger.info(f"Requesting psychological analysis from Gemini model '{model_name}'...")
+    history = [record for score, record in matches if score >= CONTEXT_MIN_SIMILARITY]
+    if history:
+        earlier_scenes = "\n".join(
+            f"- Scene: '{record['caption']}'\n  Earlier analysis: {record['analysis'][:CONTEXT_ANALYSIS_CHARS]}"
+            for record in history
+        )
+        user_prompt += f"\n\nFor reference, similar earlier sandbox scenes from the same child:\n{earlier_scenes}"
+        logger.info(f"Added {len(history)} similar earlier scenes to the prompt.")
+
+    get_usage_meter().check_quota(user_id)
+
+    model_name = router.select(complex_request=bool(custom_prompt))
+    try:
+        analysis = _request_analysis(user_prompt, model_name, user_id)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while communicating with Gemini API: {e}")
+        return f"An unexpected error occurred while generating the analysis: {e}"
+
+    if user_id:
+        try:
+            get_analysis_index().add(user_id, caption, analysis, custom_prompt=bool(custom_prompt), model=model_name)
+        except Exception as e:
+            logger.warning(f"Failed to index analysis for user {user_id}: {e}")
+
+    return analysis
+
+
+def generate_session_analysis(
+    captions: List[str], user_id: Optional[str] = None, custom_prompt: Optional[str] = None
+) -> str:
+    """
+    Generate one consolidated psychological analysis for a therapy session.
+    
+    All photos of a session show the same tray as it evolves, so the captions
+    are sent together in a single Gemini request instead of one request each.
     
+    Args:
+        captions: Ordered scene descriptions, one per photo in the session.
+        user_id: User ID the call is billed to and checked against quotas (optional).
+        custom_prompt: An optional user-provided prompt to guide the analysis.
+        
+    Returns:
+        str: Psychological analysis text from the Gemini model.
+        
+    Raises:
+        QuotaExceededError: If the user's daily token quota is used up.
+    """
+    if not genai and get_replay_store().mode != "replay":
+        error_message = "Gemini API client is not configured. Please set the GEMINI_API_KEY in your .env file."
+        logger.error(error_message)
+        return error_message
+
+    scenes = "\n".join(
+        f"{index}. '{caption}'" for index, caption in enumerate(captions, start=1)
+    )
+    session_scene = (
+        "the following photos of the same sandbox, taken in order during one "
+        f"therapy session:\n{scenes}"
+    )
+
+    # Construct the final prompt for the user role
+    if custom_prompt:
+        user_prompt = f"{custom_prompt}\n\nBased on the instruction above, please provide a single psychological analysis of how the scene evolves across {session_scene}"
+        logger.info(f"Using custom prompt for session analysis of {len(captions)} photos.")
+    else:
+        user_prompt = f"Please provide a single psychological analysis of how the scene evolves across {session_scene}"
+        logger.info(f"Using default prompt for session analysis of {len(captions)} photos.")
+
+    get_usage_meter().check_quota(user_id)
+
     try:
+        return _request_analysis(user_prompt, router.select(complex_request=True), user_id)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while communicating with Gemini API: {e}")
+        return f"An unexpected error occurred while generating the analysis: {e}"
+
+
+def _request_analysis(user_prompt: str, model_name: str, user_id: Optional[str] = None) -> str:
+    """
+    Send a prepared user prompt to Gemini and return the analysis text.
+    
+    Token usage and latency of the call are recorded for the user, and the
+    outcome is reported to the model router.
+    
+    Args:
+        user_prompt: Fully constructed prompt for the user role.
+        model_name: Gemini model to use.
+        user_id: User ID the call is billed to (optional).
+        
+    Returns:
+        str: Psychological analysis text from the Gemini model.
+        
+    Raises:
+        Exception: Any error raised while communicating with Gemini API.
+    """
+    logger.info(f"Requesting psychological analysis from Gemini model '{model_name}'...")
+    
+    def call_gemini():
         # Initialize the model with the system instruction
         model = genai.GenerativeModel(
             model_name=model_name,
             system_instruction=SYSTEM_PROMPT
         )
-        
-        # Generate content
-        response = model.generate_content(user_prompt)
-        
+        return model.generate_content(user_prompt)
+    
+    # Generate content (live, recorded, or replayed from a fixture)
+    start = time.perf_counter()
+    try:
+        response = get_replay_store().generate(model_name, user_prompt, call_gemini)
         analysis = response.text
-        logger.info("Successfully received analysis from Gemini API.")
-        return analysis.strip()
-
-    except Exception as e:
-        logger.error(f"An unexpected error occurred while communicating with Gemini API: {e}")
-        return f"An unexpected error occurred while generating the analysis: {e}"
+    except Exception:
+        latency_ms = (time.perf_counter() - start) * 1000
+        router.record(model_name, latency_ms, ok=False)
+        get_usage_meter().record(user_id, model_name, latency_ms=latency_ms, error=True)
+        raise
+    latency_ms = (time.perf_counter() - start) * 1000
+    router.record(model_name, latency_ms, ok=True)
+    
+    logger.info("Successfully received analysis from Gemini API.")
+    
+    usage = getattr(response, "usage_metadata", None)
+    get_usage_meter().record(
+        user_id,
+        model_name,
+        input_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+        output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+        latency_ms=latency_ms,
+    )
+    return analysis.strip()
 
 
 def analyze_emotion_trend(analysis_history: list) -> dict:
@@ -1,24 +1,42 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from datetime import datetime
+import asyncio
 import logging
-from typing import Optional
+import os
+from typing import List, Optional
 
-from .models import AnalysisResult, HealthCheck, ErrorResponse
+from .models import AnalysisResult, SessionAnalysisResult, UsageReport, HealthCheck, ErrorResponse
 from .caption import generate_caption, validate_image
-from .analysis import generate_psychological_analysis
+from .analysis import generate_psychological_analysis, generate_session_analysis
+from .usage import QuotaExceededError, get_usage_meter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum number of photos accepted in one session
+MAX_SESSION_PHOTOS = int(os.getenv("MAX_SESSION_PHOTOS", "12"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Write buffered usage records before the server stops"""
+    yield
+    get_usage_meter().flush()
+
+
 # Create FastAPI application
 app = FastAPI(
     title="AI Sandbox Psychological Analysis System",
     description="AI-assisted system for emotion recognition and psychological sandbox interaction for children with autism",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 
@@ -85,6 +103,9 @@ async def analyze_sandbox(
         
     except HTTPException:
         raise
+    except QuotaExceededError as e:
+        logger.warning(str(e))
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         logger.error(f"Error occurred while processing sandbox analysis: {e}")
         raise HTTPException(
@@ -93,16 +114,105 @@ async def analyze_sandbox(
         )
 
 
+@app.post("/analyze_session/", response_model=SessionAnalysisResult)
+async def analyze_session(
+    files: List[UploadFile] = File(..., description="Ordered sandbox photos from one session"),
+    user_id: str = Form(..., description="User ID"),
+    prompt: Optional[str] = Form(None, description="Custom prompt for the analysis (optional)")
+):
+    """
+    Analyze a therapy session made of several photos of the same sandbox
+    
+    - **files**: Sandbox photos in the order they were taken (supports JPEG, PNG formats, count limited by MAX_SESSION_PHOTOS)
+    - **user_id**: User ID
+    - **prompt**: A custom prompt to guide the psychological analysis (optional)
+    
+    Photos are captioned in parallel and analyzed together with a single LLM call.
+    Returns JSON response containing the ordered scene descriptions and one consolidated analysis
+    """
+    try:
+        # Limit session size, since every photo is held in memory and captioned into one prompt
+        if len(files) > MAX_SESSION_PHOTOS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Too many photos in session: {len(files)} (max {MAX_SESSION_PHOTOS})"
+            )
+        
+        images = []
+        for file in files:
+            # Validate file type
+            if not file.content_type.startswith('image/'):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Only image file formats (JPEG, PNG) are supported: {file.filename}"
+                )
+            
+            # Read file content
+            image_bytes = await file.read()
+            
+            # Validate image
+            if not validate_image(image_bytes):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Invalid image format or file too large (max 10MB): {file.filename}"
+                )
+            images.append(image_bytes)
+        
+        # Generate image captions in parallel, preserving photo order
+        logger.info(f"Starting to process session of {len(images)} images for user {user_id}")
+        captions = await asyncio.gather(
+            *(run_in_threadpool(generate_caption, image_bytes) for image_bytes in images)
+        )
+        
+        # Generate one consolidated psychological analysis for the session
+        analysis = await run_in_threadpool(generate_session_analysis, list(captions), user_id, prompt)
+        
+        # Create session analysis result
+        result = SessionAnalysisResult(
+            captions=list(captions),
+            analysis=analysis,
+            timestamp=datetime.now(),
+            user_id=user_id
+        )
+        
+        logger.info(f"Successfully completed session analysis for user {user_id}")
+        return result
+        
+    except HTTPException:
+        raise
+    except QuotaExceededError as e:
+        logger.warning(str(e))
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error occurred while processing session analysis: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+
+@app.get("/usage/{user_id}", response_model=UsageReport)
+async def usage_report(user_id: str):
+    """
+    Get the LLM usage report of a user
+    
+    - **user_id**: User ID
+    
+    Returns calls, cache hits, tokens and latency per day and model, plus today's quota status
+    """
+    return UsageReport(**get_usage_meter().report(user_id))
+
+
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     """HTTP exception handler"""
     return JSONResponse(
         status_code=exc.status_code,
-        content=ErrorResponse(
+        content=jsonable_encoder(ErrorResponse(
             error=exc.detail,
             message="Request processing failed",
             timestamp=datetime.now()
-        ).dict()
+        ))
     )
 
 
@@ -112,11 +222,11 @@ async def general_exception_handler(request, exc):
     logger.error(f"Unhandled exception: {str(exc)}")
     return JSONResponse(
         status_code=500,
-        content=ErrorResponse(
+        content=jsonable_encoder(ErrorResponse(
             error="Internal server error",
             message="Server encountered an unexpected error",
             timestamp=datetime.now()
-        ).dict()
+        ))
     )
 
 
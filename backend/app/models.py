@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -11,6 +11,34 @@ class AnalysisResult(BaseModel):
     user_id: Optional[str] = None
 
 
+class SessionAnalysisResult(BaseModel):
+    """Consolidated analysis result for a multi-photo session"""
+    captions: List[str]
+    analysis: str
+    timestamp: datetime
+    user_id: str
+
+
+class ModelUsage(BaseModel):
+    """Usage totals of one model on one day"""
+    date: str
+    model: str
+    calls: int
+    cache_hits: int
+    errors: int
+    input_tokens: int
+    output_tokens: int
+    latency_ms: float
+
+
+class UsageReport(BaseModel):
+    """Per-user usage report model"""
+    user_id: str
+    usage: List[ModelUsage]
+    daily_quota: Optional[int] = None
+    tokens_used_today: int
+
+
 class SandboxAnalysis(BaseModel):
     """Sandbox analysis request model"""
     user_id: Optional[str] = None
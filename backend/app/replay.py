@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import atexit
+import shutil
+import hashlib
+import tempfile
+import logging
+import threading
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+REPLAY_MODES = ("off", "record", "replay")
+
+
+class FixtureNotFoundError(LookupError):
+    """Raised in replay mode when no recorded response matches a prompt"""
+
+
+def fixture_key(model_name: str, prompt: str) -> str:
+    """
+    Build the lookup key of a recorded call.
+
+    Args:
+        model_name: Gemini model name.
+        prompt: User prompt sent to the model.
+
+    Returns:
+        str: SHA-256 hex digest of the model name and prompt.
+    """
+    return hashlib.sha256(f"{model_name}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+class ReplayStore:
+    """
+    Record Gemini calls to a fixture file and replay them offline.
+
+    In record mode every call is made live and its prompt, model, response
+    text, token usage and latency are appended to a JSONL fixture. In replay
+    mode responses are served from the fixture, sleeping for the recorded
+    latency multiplied by `time_scale` (0 disables the delay). Repeated
+    prompts are replayed in the order they were recorded.
+
+    Outside of "off" mode the similarity index and usage store live in a
+    per-process scratch directory (see `replay_scratch_path`), so every run
+    starts from the same state and real quotas are never charged.
+    """
+
+    def __init__(self, mode: str, fixture_path: str, time_scale: float = 1.0):
+        if mode not in REPLAY_MODES:
+            raise ValueError(f"Invalid replay mode '{mode}', expected one of {REPLAY_MODES}")
+        self.mode = mode
+        self.fixture_path = fixture_path
+        self.time_scale = time_scale
+        self._fixtures: Optional[Dict[str, List[dict]]] = None
+        self._by_prompt: Dict[str, List[dict]] = {}
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, List[dict]]:
+        if self._fixtures is None:
+            self._fixtures = {}
+            if os.path.exists(self.fixture_path):
+                with open(self.fixture_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            fixture = json.loads(line)
+                            self._fixtures.setdefault(fixture["key"], []).append(fixture)
+                            self._by_prompt.setdefault(fixture["prompt"], []).append(fixture)
+            logger.info(f"Loaded {sum(map(len, self._fixtures.values()))} recorded calls from {self.fixture_path}")
+        return self._fixtures
+
+    def _next(self, position_key: str, fixtures: List[dict]) -> dict:
+        position = self._positions.get(position_key, 0)
+        self._positions[position_key] = position + 1
+        return fixtures[position % len(fixtures)]
+
+    def generate(self, model_name: str, prompt: str, call: Callable[[], object]) -> object:
+        """
+        Produce a model response according to the replay mode.
+
+        Args:
+            model_name: Gemini model name.
+            prompt: User prompt sent to the model.
+            call: Performs the live Gemini call and returns its response.
+
+        Returns:
+            object: Response with `text` and `usage_metadata` attributes.
+
+        Raises:
+            FixtureNotFoundError: In replay mode, if the prompt was never recorded.
+        """
+        if self.mode == "replay":
+            return self._replay(model_name, prompt)
+
+        start = time.perf_counter()
+        response = call()
+        if self.mode == "record":
+            self._record(model_name, prompt, response, (time.perf_counter() - start) * 1000)
+        return response
+
+    def _replay(self, model_name: str, prompt: str) -> object:
+        key = fixture_key(model_name, prompt)
+        with self._lock:
+            fixtures = self._load()
+            if key in fixtures:
+                fixture = self._next(key, fixtures[key])
+            elif prompt in self._by_prompt:
+                # The router may pick another model than at record time
+                logger.warning(f"No recording for model '{model_name}', replaying another model's response.")
+                fixture = self._next(prompt, self._by_prompt[prompt])
+            else:
+                raise FixtureNotFoundError(f"No recorded response for prompt {key[:12]} in {self.fixture_path}")
+
+        if self.time_scale > 0:
+            time.sleep(fixture["latency_ms"] * self.time_scale / 1000)
+        return SimpleNamespace(
+            text=fixture["response"],
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=fixture["input_tokens"],
+                candidates_token_count=fixture["output_tokens"],
+            ),
+        )
+
+    def _record(self, model_name: str, prompt: str, response: object, latency_ms: float) -> None:
+        usage = getattr(response, "usage_metadata", None)
+        fixture = {
+            "key": fixture_key(model_name, prompt),
+            "model": model_name,
+            "prompt": prompt,
+            "response": response.text,
+            "input_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+            "output_tokens": getattr(usage, "candidates_token_count", 0) or 0,
+            "latency_ms": round(latency_ms, 1),
+        }
+        with self._lock:
+            directory = os.path.dirname(self.fixture_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.fixture_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(fixture) + "\n")
+
+
+_store: Optional[ReplayStore] = None
+
+
+def get_replay_store() -> ReplayStore:
+    """
+    Get the shared replay store, creating it on first use.
+
+    Returns:
+        ReplayStore: Store configured from the GEMINI_REPLAY_* environment variables.
+    """
+    global _store
+    if _store is None:
+        _store = ReplayStore(
+            mode=os.getenv("GEMINI_REPLAY_MODE", "off"),
+            fixture_path=os.getenv("GEMINI_REPLAY_FIXTURE", os.path.join("fixtures", "gemini_replay.jsonl")),
+            time_scale=float(os.getenv("GEMINI_REPLAY_TIME_SCALE", "1.0")),
+        )
+    return _store
+
+
+_scratch_dir: Optional[str] = None
+
+
+def replay_scratch_path(name: str) -> Optional[str]:
+    """
+    Get a scratch location for persistent state while recording or replaying.
+
+    Args:
+        name: File or directory name inside the scratch directory.
+
+    Returns:
+        Optional[str]: Path in a per-process temporary directory, or None
+            when replay mode is off and the configured location should be used.
+    """
+    global _scratch_dir
+    if get_replay_store().mode == "off":
+        return None
+    if _scratch_dir is None:
+        _scratch_dir = tempfile.mkdtemp(prefix="gemini_replay_")
+        atexit.register(shutil.rmtree, _scratch_dir, ignore_errors=True)
+        logger.info(f"Using scratch directory {_scratch_dir} for index and usage data")
+    return os.path.join(_scratch_dir, name)
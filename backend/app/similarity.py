@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .replay import replay_scratch_path
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Dimension of the hashed caption embeddings
+EMBEDDING_DIM = 512
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def embed_text(text: str) -> np.ndarray:
+    """
+    Embed text into a normalized vector on the CPU.
+
+    Words and word pairs are hashed into a fixed number of signed buckets
+    (feature hashing), so no model download is needed and the same text
+    always maps to the same vector across processes.
+
+    Args:
+        text: Text to embed.
+
+    Returns:
+        np.ndarray: Unit-length float32 vector of size EMBEDDING_DIM.
+    """
+    tokens = _TOKEN_PATTERN.findall(text.lower())
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for feature in features:
+        digest = hashlib.md5(feature.encode("utf-8")).digest()
+        bucket = int.from_bytes(digest[:4], "little") % EMBEDDING_DIM
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class AnalysisIndex:
+    """
+    Per-user similarity index over past caption/analysis pairs.
+
+    Each user gets a `.npy` matrix of caption embeddings, opened with mmap
+    when loaded, and a `.jsonl` file holding the matching caption and
+    analysis text. After an `add()` the user's matrix is kept in memory.
+    Lookups are an exact dot product over the user's rows, which is fast
+    for the few hundred scenes a single child accumulates.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._records: Dict[str, List[dict]] = {}
+        self._lock = threading.Lock()
+
+    def _paths(self, user_id: str) -> Tuple[str, str]:
+        # Hash the user ID so it is always a safe file name
+        key = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+        base = os.path.join(self.index_dir, key)
+        return f"{base}.npy", f"{base}.jsonl"
+
+    def _load(self, user_id: str) -> Tuple[np.ndarray, List[dict]]:
+        if user_id not in self._vectors:
+            vectors_path, records_path = self._paths(user_id)
+            vectors = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+            records = []
+            if os.path.exists(vectors_path) and os.path.exists(records_path):
+                vectors = np.load(vectors_path, mmap_mode="r")
+                with open(records_path, "r", encoding="utf-8") as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+                # Ignore rows written without a matching record (interrupted write)
+                count = min(len(vectors), len(records))
+                vectors, records = vectors[:count], records[:count]
+            self._vectors[user_id] = vectors
+            self._records[user_id] = records
+        return self._vectors[user_id], self._records[user_id]
+
+    def search(self, user_id: str, caption: str, top_k: int = 3) -> List[Tuple[float, dict]]:
+        """
+        Find the most similar past scenes for a user.
+
+        Args:
+            user_id: User whose history is searched.
+            caption: Sandbox scene description to look up.
+            top_k: Maximum number of results.
+
+        Returns:
+            List[Tuple[float, dict]]: (similarity, record) pairs, most similar first.
+        """
+        with self._lock:
+            vectors, records = self._load(user_id)
+            if not records or top_k <= 0:
+                return []
+
+            scores = vectors @ embed_text(caption)
+            k = min(top_k, len(records))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [(float(scores[i]), records[i]) for i in best]
+
+    def add(self, user_id: str, caption: str, analysis: str, custom_prompt: bool = False,
+            model: Optional[str] = None) -> None:
+        """
+        Add a caption/analysis pair to a user's index and persist it.
+
+        Args:
+            user_id: User the scene belongs to.
+            caption: Sandbox scene description.
+            analysis: Psychological analysis generated for the scene.
+            custom_prompt: Whether the analysis was guided by a custom prompt.
+            model: Name of the model that generated the analysis (optional).
+        """
+        with self._lock:
+            vectors, records = self._load(user_id)
+            vectors_path, records_path = self._paths(user_id)
+            os.makedirs(self.index_dir, exist_ok=True)
+
+            record = {"caption": caption, "analysis": analysis, "custom_prompt": custom_prompt, "model": model}
+            updated = np.vstack([vectors, embed_text(caption)[np.newaxis, :]])
+
+            # Release the mmap of the old matrix first; mapped files cannot be replaced on Windows
+            self._vectors[user_id] = updated
+            del vectors
+
+            # Write the matrix to a temporary file and swap it in atomically
+            tmp_path = f"{vectors_path}.tmp.npy"
+            np.save(tmp_path, updated)
+            os.replace(tmp_path, vectors_path)
+            with open(records_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+            self._records[user_id] = records + [record]
+
+
+_index: Optional[AnalysisIndex] = None
+
+
+def get_analysis_index() -> AnalysisIndex:
+    """
+    Get the shared analysis index, creating it on first use.
+
+    Returns:
+        AnalysisIndex: Index stored under the ANALYSIS_INDEX_DIR directory,
+            or in a scratch directory while recording or replaying Gemini calls.
+    """
+    global _index
+    if _index is None:
+        index_dir = replay_scratch_path("analysis_index") or os.getenv("ANALYSIS_INDEX_DIR", "analysis_index")
+        _index = AnalysisIndex(index_dir)
+    return _index
@@ -0,0 +1,226 @@
+import os
+import json
+import logging
+import threading
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from .replay import replay_scratch_path
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Usage of calls made without a user ID is recorded under this key
+ANONYMOUS_USER = "anonymous"
+
+
+class QuotaExceededError(Exception):
+    """Raised when a user has used up their daily token quota"""
+
+
+class UsageMeter:
+    """
+    Records token usage, latency, cache hits and failures for every analysis.
+
+    Records are aggregated in memory per user, model and day, and buffered
+    records are appended to a JSONL store in batches. Aggregates are rebuilt
+    from the store on first use, so quotas survive restarts.
+    """
+
+    def __init__(self, store_path: str, flush_batch_size: int = 20,
+                 default_quota: int = 0, user_quotas: Optional[Dict[str, int]] = None):
+        self.store_path = store_path
+        self.flush_batch_size = flush_batch_size
+        self.default_quota = default_quota
+        self.user_quotas = user_quotas or {}
+        self._buffer: List[dict] = []
+        self._totals: Dict[str, Dict[str, Dict[str, dict]]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.store_path):
+            return
+        with open(self.store_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self._aggregate(json.loads(line))
+
+    def _aggregate(self, record: dict) -> None:
+        day = record["timestamp"][:10]
+        by_model = self._totals.setdefault(record["user_id"], {}).setdefault(day, {})
+        totals = by_model.setdefault(record["model"], {
+            "calls": 0,
+            "cache_hits": 0,
+            "errors": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "latency_ms": 0.0,
+        })
+        totals["calls"] += 1
+        totals["cache_hits"] += int(record["cache_hit"])
+        totals["errors"] += int(record.get("error", False))
+        totals["input_tokens"] += record["input_tokens"]
+        totals["output_tokens"] += record["output_tokens"]
+        totals["latency_ms"] += record["latency_ms"]
+
+    def quota_for(self, user_id: Optional[str]) -> int:
+        """
+        Get the daily token quota of a user (0 means unlimited).
+
+        Args:
+            user_id: User ID (optional). Calls without a user ID share the
+                quota of ANONYMOUS_USER.
+
+        Returns:
+            int: Daily quota in input plus output tokens.
+        """
+        return self.user_quotas.get(user_id or ANONYMOUS_USER, self.default_quota)
+
+    def tokens_used_today(self, user_id: Optional[str]) -> int:
+        """
+        Get the number of tokens a user has used today.
+
+        Args:
+            user_id: User ID (optional).
+
+        Returns:
+            int: Input plus output tokens recorded today.
+        """
+        with self._lock:
+            self._load()
+            by_model = self._totals.get(user_id or ANONYMOUS_USER, {}).get(date.today().isoformat(), {})
+            return sum(t["input_tokens"] + t["output_tokens"] for t in by_model.values())
+
+    def check_quota(self, user_id: Optional[str]) -> None:
+        """
+        Ensure a user may make another LLM call today.
+
+        Args:
+            user_id: User ID (optional). Calls without a user ID share one quota.
+
+        Raises:
+            QuotaExceededError: If the user's daily token quota is used up.
+        """
+        quota = self.quota_for(user_id)
+        if quota <= 0:
+            return
+        used = self.tokens_used_today(user_id)
+        if used >= quota:
+            raise QuotaExceededError(
+                f"Daily token quota exceeded for user {user_id} ({used}/{quota} tokens)"
+            )
+
+    def record(self, user_id: Optional[str], model: str, input_tokens: int = 0,
+               output_tokens: int = 0, latency_ms: float = 0.0, cache_hit: bool = False,
+               error: bool = False) -> None:
+        """
+        Record the usage of one analysis.
+
+        Args:
+            user_id: User ID (optional).
+            model: Name of the model that produced (or would have produced) the analysis.
+            input_tokens: Prompt tokens billed for the call.
+            output_tokens: Response tokens billed for the call.
+            latency_ms: Wall-clock latency of the call in milliseconds.
+            cache_hit: Whether the analysis was served without an LLM call.
+            error: Whether the LLM call failed.
+        """
+        record = {
+            "timestamp": datetime.now().isoformat(),
+            "user_id": user_id or ANONYMOUS_USER,
+            "model": model,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "latency_ms": round(latency_ms, 1),
+            "cache_hit": cache_hit,
+            "error": error,
+        }
+        with self._lock:
+            self._load()
+            self._aggregate(record)
+            self._buffer.append(record)
+            if len(self._buffer) >= self.flush_batch_size:
+                self._flush()
+
+    def flush(self) -> None:
+        """Write all buffered records to the store."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        directory = os.path.dirname(self.store_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.store_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record) + "\n" for record in self._buffer)
+            logger.info(f"Flushed {len(self._buffer)} usage records to {self.store_path}")
+            self._buffer = []
+        except OSError as e:
+            # Keep the records buffered and retry on the next flush
+            logger.error(f"Failed to flush usage records: {e}")
+
+    def report(self, user_id: str) -> dict:
+        """
+        Summarize the recorded usage of a user.
+
+        Args:
+            user_id: User ID.
+
+        Returns:
+            dict: Totals per day and model, plus today's quota status.
+        """
+        with self._lock:
+            self._load()
+            days = []
+            for day, by_model in sorted(self._totals.get(user_id, {}).items()):
+                for model, totals in sorted(by_model.items()):
+                    days.append({"date": day, "model": model, **totals,
+                                 "latency_ms": round(totals["latency_ms"], 1)})
+
+        quota = self.quota_for(user_id)
+        return {
+            "user_id": user_id,
+            "usage": days,
+            "daily_quota": quota or None,
+            "tokens_used_today": self.tokens_used_today(user_id),
+        }
+
+
+def _parse_user_quotas(raw: str) -> Dict[str, int]:
+    try:
+        return {str(user): int(quota) for user, quota in json.loads(raw).items()}
+    except (ValueError, AttributeError) as e:
+        logger.error(f"Invalid USAGE_USER_QUOTAS value, ignoring per-user quotas: {e}")
+        return {}
+
+
+_meter: Optional[UsageMeter] = None
+
+
+def get_usage_meter() -> UsageMeter:
+    """
+    Get the shared usage meter, creating it on first use.
+
+    Returns:
+        UsageMeter: Meter configured from the USAGE_* environment variables.
+            While recording or replaying Gemini calls the store is a scratch file.
+    """
+    global _meter
+    if _meter is None:
+        _meter = UsageMeter(
+            store_path=(
+                replay_scratch_path("usage.jsonl")
+                or os.getenv("USAGE_STORE_PATH", os.path.join("usage", "usage.jsonl"))
+            ),
+            flush_batch_size=int(os.getenv("USAGE_FLUSH_BATCH_SIZE", "20")),
+            default_quota=int(os.getenv("USAGE_DAILY_TOKEN_QUOTA", "0")),
+            user_quotas=_parse_user_quotas(os.getenv("USAGE_USER_QUOTAS", "{}")),
+        )
+    return _meter
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Replay benchmark for the AI Sandbox Psychological Analysis System
+Runs the caption and analysis pipeline against recorded Gemini responses,
+so throughput can be compared offline and deterministically across code changes.
+Replay with the same images and user ID, and at most as many iterations, as the recording.
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline with recorded Gemini calls")
+    parser.add_argument("--record", action="store_true",
+                        help="Call the live Gemini API and record the fixture instead of replaying it")
+    parser.add_argument("--fixture", default=os.path.join("fixtures", "gemini_replay.jsonl"),
+                        help="Fixture file to record to or replay from")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Multiplier for recorded latencies during replay (0 disables delays)")
+    parser.add_argument("--iterations", type=int, default=20,
+                        help="Number of pipeline runs")
+    parser.add_argument("--images", nargs="+", default=["test_image.jpg"],
+                        help="Sandbox photos, used in turn for each run")
+    parser.add_argument("--user-id", default="benchmark_user",
+                        help="User ID sent with every run, empty to send none (exercises the similarity index and metering)")
+    parser.add_argument("--allow-reuse", action="store_true",
+                        help="Let near-identical captions reuse earlier analyses instead of calling the LLM")
+    return parser.parse_args()
+
+
+def print_latencies(label, latencies):
+    """Print latency percentiles of a group of runs"""
+    if not latencies:
+        print(f"✅ {label}: no runs")
+        return
+    latencies = sorted(latencies)
+    print(f"✅ {label}: {len(latencies)} runs, "
+          f"p50 {statistics.median(latencies):.1f} ms, "
+          f"p95 {latencies[int(0.95 * (len(latencies) - 1))]:.1f} ms, "
+          f"max {latencies[-1]:.1f} ms")
+
+
+def main():
+    """Main benchmark function"""
+    args = parse_args()
+
+    # The replay store reads its configuration on first use
+    os.environ["GEMINI_REPLAY_MODE"] = "record" if args.record else "replay"
+    os.environ["GEMINI_REPLAY_FIXTURE"] = args.fixture
+    os.environ["GEMINI_REPLAY_TIME_SCALE"] = str(args.time_scale)
+    if not args.allow_reuse:
+        # Similarity never exceeds 1, so every run goes through the LLM pipeline
+        os.environ["ANALYSIS_REUSE_SIMILARITY"] = "2"
+
+    from app.caption import generate_caption
+    from app.analysis import generate_psychological_analysis
+    from app.usage import ANONYMOUS_USER, get_usage_meter
+
+    meter = get_usage_meter()
+    report_user = args.user_id or ANONYMOUS_USER
+
+    def cache_hits():
+        return sum(u["cache_hits"] for u in meter.report(report_user)["usage"])
+
+    images = []
+    for image_path in args.images:
+        with open(image_path, "rb") as f:
+            images.append(f.read())
+
+    mode = "Recording" if args.record else "Replaying"
+    print(f"🚀 {mode} {args.iterations} pipeline runs ({args.fixture})")
+
+    # Index and usage data go to a scratch directory, so every run starts from the same state
+    llm_latencies = []
+    cache_latencies = []
+    start = time.perf_counter()
+    for iteration in range(args.iterations):
+        hits_before = cache_hits()
+        run_start = time.perf_counter()
+        caption = generate_caption(images[iteration % len(images)])
+        analysis = generate_psychological_analysis(caption, args.user_id or None)
+        latency_ms = (time.perf_counter() - run_start) * 1000
+        if cache_hits() > hits_before:
+            cache_latencies.append(latency_ms)
+        else:
+            llm_latencies.append(latency_ms)
+        if analysis.startswith("An unexpected error occurred"):
+            print(f"❌ {analysis}")
+            return False
+    elapsed = time.perf_counter() - start
+
+    print(f"✅ Throughput: {args.iterations / elapsed:.2f} runs/s")
+    print_latencies("LLM-served latency", llm_latencies)
+    if cache_latencies:
+        print_latencies("Cache-hit latency", cache_latencies)
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
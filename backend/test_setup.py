@@ -22,7 +22,11 @@ def test_project_structure():
         "app/main.py",
         "app/models.py",
         "app/caption.py",
-        "app/analysis.py"
+        "app/analysis.py",
+        "app/similarity.py",
+        "app/usage.py",
+        "app/replay.py",
+        "test_image.jpg"
     ]
     
     missing_files = []
@@ -53,9 +57,21 @@ def test_imports():
         print("✅ app.caption imported successfully")
         
         # Test importing analysis
-        from app.analysis import generate_psychological_analysis
+        from app.analysis import generate_psychological_analysis, generate_session_analysis
         print("✅ app.analysis imported successfully")
         
+        # Test importing similarity index
+        from app.similarity import AnalysisIndex, embed_text
+        print("✅ app.similarity imported successfully")
+        
+        # Test importing usage metering
+        from app.usage import UsageMeter, QuotaExceededError
+        print("✅ app.usage imported successfully")
+        
+        # Test importing record/replay layer
+        from app.replay import ReplayStore, FixtureNotFoundError
+        print("✅ app.replay imported successfully")
+        
         # Test importing main app
         from app.main import app
         print("✅ app.main imported successfully")
@@ -75,14 +91,15 @@ def test_mock_functions():
     
     try:
         from app.caption import generate_caption, validate_image
-        from app.analysis import generate_psychological_analysis
+        from app.analysis import generate_psychological_analysis, generate_session_analysis
         
         # Test image validation
-        test_image_bytes = b"fake_image_data"
-        is_valid = validate_image(test_image_bytes)
+        is_valid = validate_image(b"fake_image_data")
         print(f"✅ Image validation test: {is_valid}")
         
-        # Test caption generation
+        # Test caption generation with the bundled sandbox photo
+        with open("test_image.jpg", "rb") as f:
+            test_image_bytes = f.read()
         caption = generate_caption(test_image_bytes)
         print(f"✅ Caption generation test: {caption[:50]}...")
         
@@ -90,6 +107,10 @@ def test_mock_functions():
         analysis = generate_psychological_analysis(caption)
         print(f"✅ Analysis generation test: {analysis[:50]}...")
         
+        # Test session analysis
+        session_analysis = generate_session_analysis([caption, caption], "test_user")
+        print(f"✅ Session analysis generation test: {session_analysis[:50]}...")
+        
         return True
         
     except Exception as e:
@@ -135,6 +156,305 @@ def test_pydantic_models():
         print(f"❌ Pydantic model test error: {e}")
         return False
 
+def test_session_analysis():
+    """Test the consolidated session prompt and the session size limit"""
+    print("\n🔍 Testing session analysis...")
+    
+    try:
+        import io
+        import asyncio
+        from fastapi import HTTPException, UploadFile
+        import app.analysis as analysis
+        from app.main import analyze_session, MAX_SESSION_PHOTOS
+        
+        # Capture the prompt and model instead of calling Gemini
+        requests = []
+        
+        def fake_request_analysis(prompt, model_name, user_id=None):
+            requests.append((prompt, model_name))
+            return "Session analysis"
+        
+        original_request_analysis = analysis._request_analysis
+        analysis._request_analysis = fake_request_analysis
+        try:
+            result = analysis.generate_session_analysis(["First scene", "Second scene", "Third scene"], "test_user")
+        finally:
+            analysis._request_analysis = original_request_analysis
+        
+        if result != "Session analysis" or len(requests) != 1:
+            print(f"❌ Expected one LLM call, got {len(requests)}")
+            return False
+        prompt, model_name = requests[0]
+        if not (prompt.index("1. 'First scene'") < prompt.index("2. 'Second scene'") < prompt.index("3. 'Third scene'")):
+            print(f"❌ Captions are not numbered in order: {prompt}")
+            return False
+        print("✅ Captions numbered in order in a single prompt")
+        if model_name != analysis.router.primary_model:
+            print(f"❌ Session routed to '{model_name}' instead of the primary model")
+            return False
+        print("✅ Session routed to the primary model")
+        
+        # Too many photos are rejected before any file is read
+        files = [UploadFile(file=io.BytesIO(b""), filename=f"photo_{i}.jpg") for i in range(MAX_SESSION_PHOTOS + 1)]
+        try:
+            asyncio.run(analyze_session(files=files, user_id="test_user", prompt=None))
+            print("❌ Oversized session was not rejected")
+            return False
+        except HTTPException as e:
+            if e.status_code != 400:
+                print(f"❌ Oversized session returned {e.status_code} instead of 400")
+                return False
+        print("✅ Oversized session rejected with 400")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Session analysis test error: {e}")
+        return False
+
+def test_model_router():
+    """Test model selection and automatic shifting between models"""
+    print("\n🔍 Testing model router...")
+    
+    try:
+        import time
+        from app.analysis import ModelRouter
+        
+        router = ModelRouter("primary-model", "fast-model", latency_threshold_ms=1000,
+                             error_rate_threshold=0.5, window_seconds=60, min_samples=3)
+        if router.select(complex_request=True) != "primary-model" or router.select(complex_request=False) != "fast-model":
+            print("❌ Requests were not routed by complexity")
+            return False
+        print("✅ Requests routed by complexity")
+        
+        # A failing primary model shifts complex requests to the fast model
+        for _ in range(3):
+            router.record("primary-model", 100, ok=False)
+        if router.select(complex_request=True) != "fast-model":
+            print("❌ Traffic did not shift away from a failing model")
+            return False
+        print("✅ Traffic shifted on high error rate")
+        
+        # A slow fast model shifts simple requests to the primary model unless both are degraded
+        for _ in range(3):
+            router.record("fast-model", 5000, ok=True)
+        if router.select(complex_request=False) != "fast-model" or router.select(complex_request=True) != "primary-model":
+            print("❌ Both degraded models should keep their preferred routing")
+            return False
+        print("✅ Preferred routing kept when both models are degraded")
+        
+        slow_router = ModelRouter("primary-model", "fast-model", latency_threshold_ms=1000,
+                                  error_rate_threshold=0.5, window_seconds=0.05, min_samples=3)
+        for _ in range(3):
+            slow_router.record("fast-model", 5000, ok=True)
+        if slow_router.select(complex_request=False) != "primary-model":
+            print("❌ Traffic did not shift away from a slow model")
+            return False
+        print("✅ Traffic shifted on high latency")
+        
+        # Degraded calls age out of the window and traffic returns
+        time.sleep(0.1)
+        if slow_router.select(complex_request=False) != "fast-model":
+            print("❌ Traffic did not return after the window expired")
+            return False
+        print("✅ Traffic returned after the window expired")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Model router test error: {e}")
+        return False
+
+def test_usage_meter():
+    """Test usage aggregation, batched flushing and quota enforcement"""
+    print("\n🔍 Testing usage meter...")
+    
+    try:
+        import tempfile
+        from app.usage import UsageMeter, QuotaExceededError
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_path = os.path.join(tmp_dir, "usage.jsonl")
+            meter = UsageMeter(store_path, flush_batch_size=2, default_quota=100,
+                               user_quotas={"vip_user": 0})
+            
+            meter.record("test_user", "test-model", input_tokens=60, output_tokens=50, latency_ms=1200.0)
+            meter.check_quota("vip_user")
+            meter.check_quota(None)
+            try:
+                meter.check_quota("test_user")
+                print("❌ Quota was not enforced")
+                return False
+            except QuotaExceededError:
+                print("✅ Quota enforced")
+            
+            # The second record fills the batch and is flushed to the store
+            meter.record("test_user", "test-model", latency_ms=300.0, error=True)
+            meter.record("test_user", "test-model", cache_hit=True)
+            
+            # Only flushed records are visible to a new meter
+            report = UsageMeter(store_path).report("test_user")
+            totals = report["usage"][0]
+            if (totals["calls"], totals["errors"], totals["cache_hits"]) != (2, 1, 0):
+                print(f"❌ Unexpected flushed totals: {totals}")
+                return False
+            print("✅ Records flushed in batches")
+            
+            report = meter.report("test_user")
+            totals = report["usage"][0]
+            if (totals["calls"], totals["cache_hits"], report["tokens_used_today"]) != (3, 1, 110):
+                print(f"❌ Unexpected report: {report}")
+                return False
+            if report["daily_quota"] != 100:
+                print(f"❌ Unexpected quota in report: {report}")
+                return False
+            print("✅ Usage report aggregated")
+            
+            # Calls without a user ID share the anonymous quota
+            meter.record(None, "test-model", input_tokens=100)
+            try:
+                meter.check_quota(None)
+                print("❌ Anonymous quota was not enforced")
+                return False
+            except QuotaExceededError:
+                print("✅ Anonymous quota enforced")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Usage meter test error: {e}")
+        return False
+
+def test_quota_response():
+    """Test that requests over quota reach the client as 429 responses"""
+    print("\n🔍 Testing quota error response...")
+    
+    try:
+        import io
+        import json
+        import asyncio
+        import tempfile
+        from fastapi import HTTPException, UploadFile
+        from starlette.datastructures import Headers
+        import app.usage as usage
+        from app.main import analyze_sandbox, http_exception_handler
+        
+        with open("test_image.jpg", "rb") as f:
+            image_bytes = f.read()
+        
+        original_meter = usage._meter
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            usage._meter = usage.UsageMeter(os.path.join(tmp_dir, "usage.jsonl"), default_quota=10)
+            usage._meter.record("test_user", "test-model", input_tokens=10)
+            try:
+                upload = UploadFile(file=io.BytesIO(image_bytes), filename="test_image.jpg",
+                                    headers=Headers({"content-type": "image/jpeg"}))
+                asyncio.run(analyze_sandbox(file=upload, user_id="test_user", prompt=None))
+                print("❌ Request over quota was not rejected")
+                return False
+            except HTTPException as e:
+                response = asyncio.run(http_exception_handler(None, e))
+            finally:
+                usage._meter = original_meter
+        
+        body = json.loads(response.body)
+        if response.status_code != 429 or "quota exceeded" not in body["error"]:
+            print(f"❌ Unexpected response: {response.status_code} {body}")
+            return False
+        print("✅ Request over quota returned 429 with an error body")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Quota response test error: {e}")
+        return False
+
+def test_analysis_index():
+    """Test adding scenes to the similarity index and searching them"""
+    print("\n🔍 Testing similarity index...")
+    
+    try:
+        import tempfile
+        from app.similarity import AnalysisIndex
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index = AnalysisIndex(tmp_dir)
+            if index.search("test_user", "A castle with towers and a moat"):
+                print("❌ Empty index returned results")
+                return False
+            
+            index.add("test_user", "A tree in the middle of the sandbox", "Tree analysis")
+            index.add("test_user", "A castle with towers and a moat", "Castle analysis", custom_prompt=True)
+            index.add("other_user", "A castle with towers and a moat", "Other analysis")
+            print("✅ Scenes added")
+            
+            # Reload from disk to check persistence and per-user separation
+            reloaded = AnalysisIndex(tmp_dir)
+            results = reloaded.search("test_user", "A castle with towers and a moat", top_k=5)
+            if len(results) != 2 or results[0][1]["analysis"] != "Castle analysis":
+                print(f"❌ Unexpected search results: {results}")
+                return False
+            if results[0][0] < 0.99 or results[0][1]["custom_prompt"] is not True:
+                print(f"❌ Unexpected top result: {results[0]}")
+                return False
+            print("✅ Search returned the user's most similar scene")
+            
+            # Adding after a reload replaces the mmapped matrix file
+            reloaded.add("test_user", "A family of figures standing together", "Family analysis")
+            if len(AnalysisIndex(tmp_dir).search("test_user", "family", top_k=5)) != 3:
+                print("❌ Index did not grow after reload")
+                return False
+            print("✅ Index grows after reload")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Similarity index test error: {e}")
+        return False
+
+def test_replay_store():
+    """Test recording a Gemini call and replaying it offline"""
+    print("\n🔍 Testing record/replay store...")
+    
+    try:
+        import tempfile
+        from types import SimpleNamespace
+        from app.replay import ReplayStore, FixtureNotFoundError
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fixture_path = os.path.join(tmp_dir, "fixture.jsonl")
+            live_response = SimpleNamespace(
+                text="Recorded analysis",
+                usage_metadata=SimpleNamespace(prompt_token_count=12, candidates_token_count=34)
+            )
+            
+            # Record a call
+            recorder = ReplayStore("record", fixture_path)
+            recorder.generate("test-model", "test prompt", lambda: live_response)
+            print("✅ Call recorded")
+            
+            # Replay it without calling the live API
+            replayer = ReplayStore("replay", fixture_path, time_scale=0)
+            response = replayer.generate("test-model", "test prompt", lambda: None)
+            if response.text != "Recorded analysis" or response.usage_metadata.candidates_token_count != 34:
+                print("❌ Replayed response does not match the recording")
+                return False
+            print("✅ Call replayed")
+            
+            # Unknown prompts must fail instead of calling the live API
+            try:
+                replayer.generate("test-model", "unknown prompt", lambda: None)
+                print("❌ Unknown prompt was not rejected")
+                return False
+            except FixtureNotFoundError:
+                print("✅ Unknown prompt rejected")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Replay store test error: {e}")
+        return False
+
 def create_test_image():
     """Create a simple test image for testing"""
     print("\n🔍 Creating test image...")
@@ -171,6 +491,12 @@ def main():
         ("Module Imports", test_imports),
         ("Pydantic Models", test_pydantic_models),
         ("Mock Functions", test_mock_functions),
+        ("Session Analysis", test_session_analysis),
+        ("Model Router", test_model_router),
+        ("Usage Meter", test_usage_meter),
+        ("Quota Response", test_quota_response),
+        ("Similarity Index", test_analysis_index),
+        ("Replay Store", test_replay_store),
     ]
     
     passed = 0